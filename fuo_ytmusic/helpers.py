@@ -1,3 +1,27 @@
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+from ast import literal_eval
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Optional, List, Callable, Any, Dict, Tuple
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+# 空闲连接定期发送 keepalive 探测，避免被 NAT/代理悄悄断开后下次请求还要重新握手
+KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+# TCP_KEEPALIVE 是 macOS 上 TCP_KEEPIDLE 的名字
+_KEEPALIVE_TCP_OPTIONS = (('TCP_KEEPIDLE', 60), ('TCP_KEEPALIVE', 60), ('TCP_KEEPINTVL', 15), ('TCP_KEEPCNT', 4))
+for _name, _value in _KEEPALIVE_TCP_OPTIONS:
+    if hasattr(socket, _name):
+        KEEPALIVE_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, _name), _value))
+
+
 class Singleton(type):
     _instances = {}
 
@@ -5,3 +29,149 @@ class Singleton(type):
         if cls not in cls._instances:
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """为连接开启 TCP keepalive 的 HTTPAdapter"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('socket_options', KEEPALIVE_SOCKET_OPTIONS)
+        super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs.setdefault('socket_options', KEEPALIVE_SOCKET_OPTIONS)
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+
+class ExpiringCache(MutableMapping):
+    """每个条目单独计算过期时间的内存缓存，可以直接作为 cachetools.cached 的 cache 使用
+
+    ttu(key, value, now) 返回条目的过期时间，不晚于 now 的条目不会被缓存。缓存满了之后先清理过期条目，再淘汰最早写入的。
+    """
+
+    def __init__(self, maxsize: int, ttu: Callable[[Any, Any, float], float], timer=time.time):
+        self._maxsize = maxsize
+        self._ttu = ttu
+        self._timer = timer
+        self._data: Dict[Any, Tuple[Any, float]] = {}
+
+    def __getitem__(self, key):
+        value, expires_at = self._data[key]
+        if expires_at <= self._timer():
+            self._data.pop(key, None)
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        # 不经过 __getitem__ 和 KeyError，命中时只查一次字典
+        item = self._data.get(key)
+        if item is None or item[1] <= self._timer():
+            return default
+        return item[0]
+
+    def __setitem__(self, key, value):
+        now = self._timer()
+        expires_at = self._ttu(key, value, now)
+        self._data.pop(key, None)
+        if expires_at <= now:
+            return
+        if len(self._data) >= self._maxsize:
+            self._data = {k: v for k, v in self._data.items() if v[1] > now}
+            while len(self._data) >= self._maxsize:
+                self._data.pop(next(iter(self._data)))
+        self._data[key] = (value, expires_at)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __iter__(self):
+        now = self._timer()
+        return iter([k for k, v in self._data.items() if v[1] > now])
+
+    def __len__(self):
+        now = self._timer()
+        return sum(1 for v in self._data.values() if v[1] > now)
+
+
+class SqliteTTLCache(MutableMapping):
+    """基于 sqlite 的 TTL 缓存，进程重启后依然有效，可以直接作为 cachetools.cached 的 cache 使用
+
+    多个缓存可以共用同一个数据库文件，用 namespace 区分。key 需要能通过 repr/literal_eval 还原（如 str、tuple），
+    value 使用 pickle 序列化。
+    """
+
+    def __init__(self, path: Path, namespace: str, ttl: float, maxsize: int = 1000, timer=time.time):
+        self._path = path
+        self._namespace = namespace
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._timer = timer
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self._path), check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, expires_at REAL NOT NULL, '
+                         'PRIMARY KEY (namespace, key))')
+            self._conn = conn
+        return self._conn
+
+    def __getitem__(self, key):
+        try:
+            with self._lock:
+                row = self.conn.execute('SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?',
+                                        (self._namespace, repr(key))).fetchone()
+            if row is None or row[1] <= self._timer():
+                raise KeyError(key)
+            return pickle.loads(row[0])
+        except (sqlite3.Error, OSError, pickle.UnpicklingError, AttributeError, ImportError, EOFError) as e:
+            # 数据库不可用（包括数据目录无法创建）或缓存的数据已经无法还原（比如类被删除或改名），当作没有缓存。
+            # 注意 pydantic 模型增删字段后旧数据仍能还原，调用方需要自己区分版本，见 service._meta_cache
+            raise KeyError(key) from e
+
+    def __setitem__(self, key, value):
+        now = self._timer()
+        try:
+            data = pickle.dumps(value)
+            with self._lock, self.conn as conn:
+                conn.execute('INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                             (self._namespace, repr(key), data, now + self._ttl))
+                conn.execute('DELETE FROM cache WHERE expires_at <= ?', (now,))
+                conn.execute('DELETE FROM cache WHERE namespace = ? AND key NOT IN ('
+                             'SELECT key FROM cache WHERE namespace = ? ORDER BY expires_at DESC LIMIT ?)',
+                             (self._namespace, self._namespace, self._maxsize))
+        except (sqlite3.Error, OSError, pickle.PicklingError, TypeError) as e:
+            # cachetools.cached 会忽略 ValueError，写缓存失败不影响正常返回
+            raise ValueError(f'can not cache value for {key!r}') from e
+
+    def __delitem__(self, key):
+        with self._lock, self.conn as conn:
+            cursor = conn.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (self._namespace, repr(key)))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def _keys(self) -> List[str]:
+        with self._lock:
+            rows = self.conn.execute('SELECT key FROM cache WHERE namespace = ? AND expires_at > ?',
+                                     (self._namespace, self._timer())).fetchall()
+        return [row[0] for row in rows]
+
+    def __iter__(self):
+        return (literal_eval(key) for key in self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def clear(self):
+        with self._lock, self.conn as conn:
+            conn.execute('DELETE FROM cache WHERE namespace = ?', (self._namespace,))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
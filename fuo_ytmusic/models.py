@@ -1,6 +1,8 @@
-from typing import Optional, Union, List, Tuple
+from array import array
+from collections.abc import Sequence
+from typing import Optional, Union, List, Dict, Tuple
 from pydantic import BaseModel as PydanticBaseModel
-from pydantic.fields import Field
+from pydantic.fields import Field, PrivateAttr
 # noinspection PyProtectedMember
 from pydantic.main import ModelMetaclass
 
@@ -31,13 +33,58 @@ class BaseModel(PydanticBaseModel, metaclass=AllowOptional):
     def source(self):
         return 'ytmusic'
 
+    @classmethod
+    def from_trusted(cls, data: dict):
+        """跳过校验直接构造模型，用于 ytmusicapi 返回的列表数据，嵌套的模型同样递归构造
+
+        注意：字段不会做类型转换，值保持 ytmusicapi 返回的原样，比如 YtmusicSearchAlbum.year 仍然是 '2020' 这样的字符串。
+        """
+        values = {}
+        for name, field in cls.__fields__.items():
+            if field.alias not in data:
+                continue
+            value = data[field.alias]
+            type_ = field.type_
+            if value is not None and isinstance(type_, type) and issubclass(type_, BaseModel):
+                if isinstance(value, list):
+                    value = [type_.from_trusted(v) if isinstance(v, dict) else v for v in value]
+                elif isinstance(value, dict):
+                    value = type_.from_trusted(value)
+            values[name] = value
+        return cls.construct(**values)
+
+
+def artist_model(id_: Optional[str], name: Optional[str]) -> BriefArtistModel:
+    return BriefArtistModel(identifier=id_ or '', source='ytmusic', name=name)
+
+
+def album_model(id_: Optional[str], name: Optional[str]) -> BriefAlbumModel:
+    album = BriefAlbumModel(identifier=id_ or '', source='ytmusic', name=name)
+    if id_ is None:
+        album.state = ModelState.not_exists
+    return album
+
+
+def song_model(video_id: Optional[str], title: Optional[str], artists: Optional[List[BriefArtistModel]],
+               album: Optional[BriefAlbumModel], duration_ms: int) -> SongModel:
+    """搜索结果和 TrackListing 共用的 SongModel 构造逻辑"""
+    song = SongModel(identifier=video_id or '', source='ytmusic', title=title, artists=artists or [],
+                     duration=duration_ms)
+    if album is not None:
+        song.album = album
+    else:
+        song.album = BriefAlbumModel(identifier='', source='ytmusic', name='', state=ModelState.not_exists)
+    if video_id is None:
+        song.state = ModelState.not_exists
+    return song
+
 
 class SearchNestedArtist(BaseModel):
     id: str
     name: str
 
     def model(self) -> BriefArtistModel:
-        return BriefArtistModel(identifier=self.id or '', source=self.source, name=self.name)
+        return artist_model(self.id, self.name)
 
 
 class YtmusicArtistsMixin:
@@ -87,10 +134,7 @@ class YtmusicSearchSong(YtmusicSearchBase, YtmusicCoverMixin, YtmusicArtistsMixi
         name: str
 
         def model(self) -> BriefAlbumModel:
-            album = BriefAlbumModel(identifier=self.id or '', source=self.source, name=self.name)
-            if self.id is None:
-                album.state = ModelState.not_exists
-            return album
+            return album_model(self.id, self.name)
 
     title: str  # 歌名
     album: Album  # 专辑信息
@@ -100,15 +144,8 @@ class YtmusicSearchSong(YtmusicSearchBase, YtmusicCoverMixin, YtmusicArtistsMixi
     isExplicit: bool
 
     def model(self) -> SongModel:
-        song = SongModel(identifier=self.videoId or '', source=self.source, title=self.title, artists=self.artists_model,
-                         duration=self.duration_ms)
-        if self.album is not None:
-            song.album = self.album.model()
-        else:
-            song.album = BriefAlbumModel(identifier='', source=self.source, name='', state=ModelState.not_exists)
-        if self.videoId is None:
-            song.state = ModelState.not_exists
-        return song
+        return song_model(self.videoId, self.title, self.artists_model,
+                          self.album.model() if self.album is not None else None, self.duration_ms)
 
 
 class YtmusicLibrarySong(YtmusicSearchSong):
@@ -119,6 +156,44 @@ class YtmusicHistorySong(YtmusicLibrarySong):
     played: str  # 上次播放 eg November 2021
 
 
+class TrackListing(Sequence):
+    """按列存储的歌曲列表，只在取出某一行时才构造 SongModel"""
+
+    def __init__(self):
+        self.ids: List[Optional[str]] = []
+        self.titles: List[Optional[str]] = []
+        self.artists: List[Tuple[Tuple[Optional[str], Optional[str]], ...]] = []  # ((id, name), ...)
+        self.albums: List[Optional[Tuple[Optional[str], Optional[str]]]] = []  # (id, name)
+        self.duration_ms = array('i')
+
+    @classmethod
+    def from_response(cls, response: List[dict]) -> 'TrackListing':
+        listing = cls()
+        for data in response:
+            album = data.get('album')
+            duration = data.get('duration')
+            listing.ids.append(data.get('videoId'))
+            listing.titles.append(data.get('title'))
+            listing.artists.append(tuple((a.get('id'), a.get('name')) for a in data.get('artists') or []))
+            listing.albums.append((album.get('id'), album.get('name')) if album is not None else None)
+            listing.duration_ms.append(int(timeparse(duration) * 1000) if duration is not None else 0)
+        return listing
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.model(index)
+
+    def model(self, index: int) -> SongModel:
+        album = self.albums[index]
+        return song_model(self.ids[index], self.titles[index],
+                          [artist_model(id_, name) for id_, name in self.artists[index]],
+                          album_model(*album) if album is not None else None, self.duration_ms[index])
+
+
 class YtmusicSearchAlbum(YtmusicSearchBase, YtmusicCoverMixin, YtmusicArtistsMixin):
     title: str  # 专辑名
     type: str  # 专辑类型
@@ -186,7 +261,7 @@ class YtmusicDispatcher:
             -> Union[YtmusicSearchBase, YtmusicSearchVideo, YtmusicSearchSong, YtmusicSearchArtist, YtmusicSearchAlbum,
                      YtmusicSearchPlaylist]:
         clazz = cls.RESULT_TYPE_MAP.get(data.get('resultType'))
-        return clazz(**data) if clazz is not None else YtmusicSearchBase(**data)
+        return (clazz or YtmusicSearchBase).from_trusted(data)
 
 
 class ArtistInfo(BaseModel):
@@ -272,10 +347,31 @@ class SongInfo(BaseModel):
         formats: List[Format]
         adaptiveFormats: List[Format]
 
+        _itag_index: Optional[Dict[int, Format]] = PrivateAttr(default=None)
+
+        def adaptive_format(self, itag: int) -> Optional[Format]:
+            if self._itag_index is None:
+                self._itag_index = {int(f.itag): f for f in self.adaptiveFormats or []}
+            return self._itag_index.get(int(itag))
+
     videoDetails: VideoDetails
     streamingData: StreamingData
 
+    # 选择音质、获取播放链接时会反复用到，第一次计算后缓存起来
+    _formats: Optional[List[Quality.Audio]] = PrivateAttr(default=None)
+    _video_formats: Optional[List[Quality.Video]] = PrivateAttr(default=None)
+
     def list_formats(self) -> List[Quality.Audio]:
+        if self._formats is None:
+            self._formats = self._list_formats()
+        return self._formats
+
+    def list_video_formats(self) -> List[Quality.Video]:
+        if self._video_formats is None:
+            self._video_formats = self._list_video_formats()
+        return self._video_formats
+
+    def _list_formats(self) -> List[Quality.Audio]:
         qualities = set()
         if self.streamingData is None:
             return []
@@ -290,7 +386,7 @@ class SongInfo(BaseModel):
                 qualities.add(Quality.Audio.hq)
         return list(qualities)
 
-    def list_video_formats(self) -> List[Quality.Video]:
+    def _list_video_formats(self) -> List[Quality.Video]:
         qualities = set()
         for format_ in self.streamingData.adaptiveFormats:
             if format_.audioQuality is not None:
@@ -305,30 +401,30 @@ class SongInfo(BaseModel):
                 qualities.add(Quality.Video.ld)
         return list(qualities)
 
-    def get_media(self, quality: Quality.Audio) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+    def get_media(self, quality: Quality.Audio) -> Optional[StreamingData.Format]:
         for format_ in self.streamingData.adaptiveFormats:
             if format_.audioQuality is None:
                 continue
             if quality in (Quality.Audio.hq, Quality.Audio.shq) and format_.audioQuality == 'AUDIO_QUALITY_HIGH':
-                return format_.itag, int(format_.bitrate / 1024), format_.mimeType
+                return format_
             if quality == Quality.Audio.sq and format_.audioQuality == 'AUDIO_QUALITY_MEDIUM':
-                return format_.itag, int(format_.bitrate / 1024), format_.mimeType
+                return format_
             if quality == Quality.Audio.lq and format_.audioQuality == 'AUDIO_QUALITY_LOW':
-                return format_.itag, int(format_.bitrate / 1024), format_.mimeType
-        return None, None, None
+                return format_
+        return None
 
-    def get_mv(self, quality) -> Optional[int]:
+    def get_mv(self, quality) -> Optional[StreamingData.Format]:
         for format_ in self.streamingData.adaptiveFormats:
             if format_.audioQuality is not None:
                 continue
             if quality == Quality.Video.fhd and format_.quality == 'hd1080':
-                return format_.itag
+                return format_
             if quality == Quality.Video.hd and format_.quality == 'hd720':
-                return format_.itag
+                return format_
             if quality == Quality.Video.sd and format_.quality == 'large':
-                return format_.itag
+                return format_
             if quality == Quality.Video.ld and format_.quality == 'medium':
-                return format_.itag
+                return format_
         return None
 
 
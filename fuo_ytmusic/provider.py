@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 
 from feeluown.excs import NoUserLoggedIn
@@ -11,6 +12,8 @@ from fuo_ytmusic.consts import HEADER_FILE
 from fuo_ytmusic.models import YtmusicPlaylistModel, Categories
 from fuo_ytmusic.service import YtmusicService, YtmusicType
 
+PREFETCH_COUNT = 3  # 预取接下来几首歌曲的信息
+
 
 class YtmusicProvider(AbstractProvider, ProviderV2):
     service: YtmusicService
@@ -19,6 +22,10 @@ class YtmusicProvider(AbstractProvider, ProviderV2):
         super(YtmusicProvider, self).__init__()
         self.service: YtmusicService = YtmusicService()
         self._user = None
+        # 按流量计费的网络下可以关闭预取
+        self.prefetch_enabled = True
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ytmusic-prefetch')
+        self._prefetch_queue: List[str] = []
 
     # noinspection PyPep8Naming
     class meta:
@@ -47,8 +54,9 @@ class YtmusicProvider(AbstractProvider, ProviderV2):
         self._user = user
 
     def library_songs(self):
-        songs = self.service.library_songs(100)
-        return [song.model() for song in songs]
+        # feeluown 的 reader 第一次读取就会切片取出全部歌曲，返回 TrackListing 只会让 SongModel 改在 Qt 线程中构造，
+        # 所以在这里（调用方的 aio.run_fn 线程中）一次性构造好
+        return list(self.service.library_songs(100))
 
     def library_albums(self):
         albums = self.service.library_albums(100)
@@ -63,7 +71,23 @@ class YtmusicProvider(AbstractProvider, ProviderV2):
         return [playlist.model(self) for playlist in playlists]
 
     def playlist_info(self, identifier) -> YtmusicPlaylistModel:
-        return self.service.playlist_info(identifier, limit=20).model()
+        playlist = self.service.playlist_info(identifier, limit=20)
+        self._prefetch_queue = [track.videoId for track in playlist.tracks if track.videoId is not None]
+        self._prefetch(self._prefetch_queue[:PREFETCH_COUNT])
+        return playlist.model()
+
+    def _prefetch(self, video_ids: List[str]):
+        if not self.prefetch_enabled or not video_ids:
+            return
+        self._prefetch_executor.submit(self.service.song_info_many, video_ids)
+
+    def _prefetch_next(self, video_id: str):
+        # 当前歌曲在最近打开的歌单中时，预取它之后的几首
+        try:
+            index = self._prefetch_queue.index(video_id)
+        except ValueError:
+            return
+        self._prefetch(self._prefetch_queue[index + 1:index + 1 + PREFETCH_COUNT])
 
     def categories(self) -> Categories:
         return self.service.categories()
@@ -102,9 +126,14 @@ class YtmusicProvider(AbstractProvider, ProviderV2):
 
     def song_get_media(self, song: SongModel, quality: Quality.Audio) -> Optional[Media]:
         song_info = self.service.song_info(song.identifier)
-        format_code, bitrate, format_str = song_info.get_media(quality)
-        url = self.service.stream_url(song.identifier, format_code)
-        return Media(url, type_=MediaType.audio, bitrate=bitrate, format=format_str) if url is not None else None
+        format_ = song_info.get_media(quality)
+        if format_ is None:
+            return None
+        url = self.service.stream_url_for_format(song.identifier, format_)
+        self._prefetch_next(song.identifier)
+        if url is None:
+            return None
+        return Media(url, type_=MediaType.audio, bitrate=int(format_.bitrate / 1024), format=format_.mimeType)
 
     def song_get_lyric(self, song):
         # 歌词获取报错的 workaround
@@ -117,11 +146,14 @@ class YtmusicProvider(AbstractProvider, ProviderV2):
 
     def video_get_media(self, video, quality) -> Optional[Media]:
         song_info = self.service.song_info(video.identifier)
-        format_code = song_info.get_mv(quality)
+        video_format = song_info.get_mv(quality)
         audio_formats = song_info.list_formats()
-        audio_code, _, __ = song_info.get_media(audio_formats[0])
-        url = self.service.stream_url(video.identifier, format_code)
-        audio_url = self.service.stream_url(video.identifier, audio_code)
+        audio_format = song_info.get_media(audio_formats[0])
+        if video_format is None or audio_format is None:
+            return None
+        url, audio_url = self.service.gather(
+            lambda: self.service.stream_url_for_format(video.identifier, video_format),
+            lambda: self.service.stream_url_for_format(video.identifier, audio_format))
         if url is None or audio_url is None:
             return None
         return Media(VideoAudioManifest(url, audio_url))
@@ -1,33 +1,76 @@
+import hashlib
+import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import timedelta
 from enum import Enum
-from functools import partial
-from typing import Optional, Union, List
-from urllib.parse import unquote
+from threading import RLock, Lock
+from types import SimpleNamespace
+from typing import Optional, Union, List, Callable, TypeVar, Dict
+from urllib.parse import parse_qs, urlparse
 
-import cachetools.keys
+import cachetools
 import requests
 
 from feeluown.models import SearchType
 from pytube.cipher import Cipher
 from requests import Response
+from urllib3.util.retry import Retry
 from pytube import extract
 
-from fuo_ytmusic.consts import HEADER_FILE
-from fuo_ytmusic.helpers import Singleton
+from fuo_ytmusic.consts import HEADER_FILE, CIPHER_CACHE_FILE, CACHE_DB_FILE
+from fuo_ytmusic.helpers import Singleton, SqliteTTLCache, KeepAliveAdapter, ExpiringCache
 from fuo_ytmusic.models import YtmusicSearchSong, YtmusicSearchAlbum, YtmusicSearchArtist, YtmusicSearchVideo, \
     YtmusicSearchPlaylist, YtmusicSearchBase, YtmusicDispatcher, ArtistInfo, UserInfo, AlbumInfo, \
-    SongInfo, Categories, PlaylistNestedResult, TopCharts, YtmusicLibrarySong, YtmusicLibraryArtist, PlaylistInfo, \
+    SongInfo, Categories, PlaylistNestedResult, TopCharts, TrackListing, YtmusicLibraryArtist, PlaylistInfo, \
     YtmusicHistorySong
+import ytmusicapi.ytmusic
 from ytmusicapi import YTMusic
 from cachetools import TTLCache
 
-CACHE = TTLCache(maxsize=100, ttl=timedelta(minutes=10).seconds)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 不同接口的数据时效性差别很大，每个接口单独缓存，缓存 key 直接使用参数
+# 歌手、专辑、用户、分类等元数据变化很少，缓存到磁盘上，重启后依然有效
+META_TTL = timedelta(days=1).total_seconds()
+CATEGORIES_TTL = timedelta(days=7).total_seconds()
+SEARCH_TTL = timedelta(minutes=30).total_seconds()
+SONG_TTL = timedelta(minutes=10).total_seconds()  # 包含有时效的 streamingData
+SONG_CACHE_SIZE = 200
+STREAM_TTL = timedelta(minutes=5).total_seconds()  # 无法从链接中得知过期时间时使用
+STREAM_EXPIRE_MARGIN = timedelta(minutes=1).total_seconds()  # 提前一点过期，避免拿到即将失效的链接
+CACHE_LOCK = RLock()
 GLOBAL_LIMIT = 20
+CIPHER_TTL = timedelta(hours=6).total_seconds()  # base.js 所有视频共用，几个小时才更新一次
+MAX_WORKERS = 8  # 并发请求数，与连接池大小保持一致
+
+T = TypeVar('T')
 
 logger = logging.getLogger(__name__)
 
 
+def _orjson_loads(s, **kwargs):
+    # orjson 不支持 json.loads 的参数，带参数时交给标准库
+    return json.loads(s, **kwargs) if kwargs else orjson.loads(s)
+
+
+if orjson is not None:
+    # 歌单、搜索等接口的响应很大，用 orjson 解析。ytmusicapi 直接调用 json.loads(response.text)，
+    # 所以只替换 ytmusicapi.ytmusic 模块中的 json，不影响 feeluown 和其他插件
+    ytmusicapi.ytmusic.json = SimpleNamespace(**{**vars(json), 'loads': _orjson_loads})
+
+
+def _meta_cache(namespace: str, model: type, ttl: float, maxsize: int) -> SqliteTTLCache:
+    # pickle 还原 pydantic 模型时只恢复旧的 __dict__，模型加了字段也不会报错，读新字段才会 AttributeError。
+    # 所以命名空间带上模型结构的摘要，插件升级后模型变了就不会再读到旧结构的缓存，旧条目过期后被清理
+    digest = hashlib.md5(model.schema_json().encode()).hexdigest()[:8]
+    return SqliteTTLCache(CACHE_DB_FILE, f'{namespace}:{digest}', ttl, maxsize=maxsize)
+
+
 class YtmusicType(Enum):
     so = 'songs'
     vi = 'videos'
@@ -35,10 +78,41 @@ class YtmusicType(Enum):
     al = 'albums'
     pl = 'playlists'
 
-    # noinspection PyTypeChecker
     @classmethod
     def parse(cls, type_: SearchType) -> 'YtmusicType':
-        return cls._value2member_map_.get(type_.value + 's')
+        return _SEARCH_TYPE_MAP.get(type_)
+
+
+# 搜索时每次都会用到，提前建好映射
+# noinspection PyTypeChecker
+_SEARCH_TYPE_MAP = {t: YtmusicType._value2member_map_.get(t.value + 's') for t in SearchType}
+
+
+def parse_signature_cipher(signature_cipher: str) -> Dict[str, str]:
+    """解析 signatureCipher，返回加密签名 s、签名参数名 sp 和未签名的 url"""
+    params = parse_qs(signature_cipher)
+    return {key: params[key][0] if key in params else default
+            for key, default in (('s', ''), ('sp', 'sig'), ('url', ''))}
+
+
+def stream_url_expires_at(url: str) -> Optional[float]:
+    """从播放链接的 expire 参数中取出过期时间（时间戳）"""
+    expire = parse_qs(urlparse(url).query).get('expire')
+    try:
+        return float(expire[0]) if expire else None
+    except ValueError:
+        return None
+
+
+def _song_ttu(_, song_info: SongInfo, now: float) -> float:
+    return now + SONG_TTL
+
+
+def _stream_url_ttu(_, url: Optional[str], now: float) -> float:
+    if url is None:
+        return now  # 不缓存获取失败的结果
+    expires_at = stream_url_expires_at(url)
+    return now + STREAM_TTL if expires_at is None else expires_at - STREAM_EXPIRE_MARGIN
 
 
 class YtmusicScope(Enum):
@@ -51,8 +125,15 @@ class YtmusicService(metaclass=Singleton):
         self._session: Optional[requests.Session] = None
         self._api: Optional[YTMusic] = None
         self._js = ""
-        self._cipher = None
+        self._js_url = ""
+        self._cipher: Optional[Cipher] = None
+        self._cipher_expires_at = 0.0
+        self._cipher_lock = Lock()
         self._signature_timestamp = 0
+        self._song_cache = ExpiringCache(maxsize=SONG_CACHE_SIZE, ttu=_song_ttu, timer=time.monotonic)
+        self._song_pending: Dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='ytmusic')
+        self._load_cipher()
         self.setup()
 
     @staticmethod
@@ -60,16 +141,49 @@ class YtmusicService(metaclass=Singleton):
         logger.debug(f'[ytmusic] Requesting: [{r.request.method.upper()}] {r.url}; '
                      f'Response: [{r.status_code}] {len(r.content)} bytes.')
 
-    def setup(self):
-        del self._api, self._session
-        self._session = requests.Session()
-        self._session.hooks['response'].append(self._do_logging)
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        # 不设置 pool_block：ytmusicapi 的请求没有超时，阻塞等待连接可能让所有线程一起卡住
+        adapter = KeepAliveAdapter(pool_connections=5, pool_maxsize=MAX_WORKERS,
+                                   max_retries=Retry(total=2, backoff_factor=0.3))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.hooks['response'].append(self._do_logging)
+        return session
+
+    def setup(self, reset_session: bool = False):
+        # 登录后会重新 setup，默认复用已有的 session 以保留连接池
+        if reset_session:
+            self.close()
+        if self._session is None:
+            self._session = self._create_session()
         if HEADER_FILE.exists():
             self._api = YTMusic(HEADER_FILE, requests_session=self._session)
         else:
             self._api = YTMusic(requests_session=self._session)
         self._signature_timestamp = self._api.get_signatureTimestamp()
 
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+        self._session = None
+        self._api = None
+
+    def __enter__(self) -> 'YtmusicService':
+        if self._api is None:
+            self.setup()
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def gather(self, *calls: Callable[[], T]) -> List[T]:
+        """并发执行多个互不依赖的阻塞调用，按顺序返回结果"""
+        futures = [self._executor.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+    @cachetools.cached(cache=TTLCache(maxsize=50, ttl=SEARCH_TTL), lock=CACHE_LOCK,
+                       key=lambda _, keywords, t, scope=None, page_size=GLOBAL_LIMIT: (keywords, t, scope, page_size))
     def search(self, keywords: str, t: Optional[YtmusicType], scope: YtmusicScope = None,
                page_size: int = GLOBAL_LIMIT) \
             -> List[Union[YtmusicSearchSong, YtmusicSearchAlbum, YtmusicSearchArtist, YtmusicSearchVideo,
@@ -78,40 +192,82 @@ class YtmusicService(metaclass=Singleton):
                                     page_size)
         return [YtmusicDispatcher.search_result_dispatcher(**data) for data in response]
 
-    @cachetools.cached(cache=CACHE, key=partial(cachetools.keys.hashkey, 'artist_info'))
+    @cachetools.cached(cache=_meta_cache('artist_info', ArtistInfo, META_TTL, maxsize=100), lock=CACHE_LOCK,
+                       key=lambda _, channel_id: channel_id)
     def artist_info(self, channel_id: str) -> ArtistInfo:
         return ArtistInfo(**self._api.get_artist(channel_id))
 
-    @cachetools.cached(cache=CACHE, key=partial(cachetools.keys.hashkey, 'artist_albums'))
+    @cachetools.cached(cache=_meta_cache('artist_albums', YtmusicSearchAlbum, META_TTL, maxsize=50), lock=CACHE_LOCK,
+                       key=lambda _, channel_id, params: (channel_id, params))
     def artist_albums(self, channel_id: str, params: str) -> List[YtmusicSearchAlbum]:
         response = self._api.get_artist_albums(channel_id, params)
-        return [YtmusicSearchAlbum(**data) for data in response]
+        return [YtmusicSearchAlbum.from_trusted(data) for data in response]
 
-    @cachetools.cached(cache=CACHE, key=partial(cachetools.keys.hashkey, 'user_info'))
+    @cachetools.cached(cache=_meta_cache('user_info', UserInfo, META_TTL, maxsize=50), lock=CACHE_LOCK,
+                       key=lambda _, channel_id: channel_id)
     def user_info(self, channel_id: str) -> UserInfo:
         return UserInfo(**self._api.get_user(channel_id))
 
     def user_playlists(self, channel_id: str, params: str):
         return self._api.get_user_playlists(channel_id, params)
 
-    @cachetools.cached(cache=CACHE, key=partial(cachetools.keys.hashkey, 'album_info'))
+    @cachetools.cached(cache=_meta_cache('album_info', AlbumInfo, META_TTL, maxsize=100), lock=CACHE_LOCK,
+                       key=lambda _, browse_id: browse_id)
     def album_info(self, browse_id: str) -> AlbumInfo:
         return AlbumInfo(**self._api.get_album(browse_id))
 
-    @cachetools.cached(cache=CACHE, key=partial(cachetools.keys.hashkey, 'song_info'))
     def song_info(self, video_id: str) -> SongInfo:
-        return SongInfo(**self._api.get_song(video_id, self._signature_timestamp))
-
-    @cachetools.cached(cache=CACHE, key=partial(cachetools.keys.hashkey, 'categories'))
+        # 播放、切换音质时调用非常频繁，直接用 video_id 查缓存，不经过 cachetools
+        cached = self._song_cache.get(video_id)
+        if cached is not None:
+            return cached
+        with CACHE_LOCK:
+            cached = self._song_cache.get(video_id)
+            if cached is not None:
+                return cached
+            # 同一首歌已经在获取中（比如预取还没完成就开始播放），等待它的结果，不重复请求
+            pending = self._song_pending.get(video_id)
+            if pending is None:
+                future = self._song_pending[video_id] = Future()
+        if pending is not None:
+            return pending.result()
+        try:
+            song_info = SongInfo(**self._api.get_song(video_id, self._signature_timestamp))
+        except BaseException as e:
+            with CACHE_LOCK:
+                del self._song_pending[video_id]
+            future.set_exception(e)
+            raise
+        with CACHE_LOCK:
+            del self._song_pending[video_id]
+            self._song_cache[video_id] = song_info
+        future.set_result(song_info)
+        return song_info
+
+    def song_info_many(self, video_ids: List[str]) -> Dict[str, SongInfo]:
+        """并发获取多首歌曲的信息，结果同时写入 song_info 的缓存，获取失败的歌曲会被跳过"""
+        futures = {video_id: self._executor.submit(self.song_info, video_id) for video_id in dict.fromkeys(video_ids)}
+        results = {}
+        for video_id, future in futures.items():
+            try:
+                results[video_id] = future.result()
+            except Exception as e:
+                logger.warning(f'[ytmusic] get song info failed: {video_id} {e}')
+        return results
+
+    @cachetools.cached(cache=_meta_cache('categories', Categories, CATEGORIES_TTL, maxsize=1), lock=CACHE_LOCK,
+                       key=lambda _: ())
     def categories(self) -> Categories:
         return Categories(**self._api.get_mood_categories())
 
-    @cachetools.cached(cache=CACHE, key=partial(cachetools.keys.hashkey, 'category_playlist'))
+    @cachetools.cached(cache=_meta_cache('category_playlists', PlaylistNestedResult, META_TTL, maxsize=50),
+                       lock=CACHE_LOCK, key=lambda _, params: params)
     def category_playlists(self, params: str) -> List[PlaylistNestedResult]:
         response = self._api.get_mood_playlists(params)
-        return [PlaylistNestedResult(**data) for data in response]
+        return [PlaylistNestedResult.from_trusted(data) for data in response]
 
-    @cachetools.cached(cache=CACHE, key=partial(cachetools.keys.hashkey, 'top_charts'))
+    @cachetools.cached(cache=_meta_cache('charts', TopCharts, META_TTL, maxsize=10), lock=CACHE_LOCK,
+                       key=lambda _, country='ZZ': country)
     def get_charts(self, country: str = 'ZZ') -> TopCharts:
         # temp workaround for ytmusicapi#236
         # sees: https://github.com/sigma67/ytmusicapi/issues/236
@@ -123,23 +279,22 @@ class YtmusicService(metaclass=Singleton):
 
     def library_playlists(self, limit: int = GLOBAL_LIMIT) -> List[PlaylistNestedResult]:
         response = self._api.get_library_playlists(limit)
-        return [PlaylistNestedResult(**data) for data in response]
+        return [PlaylistNestedResult.from_trusted(data) for data in response]
 
-    def library_songs(self, limit: int = GLOBAL_LIMIT) -> List[YtmusicLibrarySong]:
-        response = self._api.get_library_songs(limit)
-        return [YtmusicLibrarySong(**data) for data in response]
+    def library_songs(self, limit: int = GLOBAL_LIMIT) -> TrackListing:
+        return TrackListing.from_response(self._api.get_library_songs(limit))
 
     def library_albums(self, limit: int = GLOBAL_LIMIT) -> List[YtmusicSearchAlbum]:
         response = self._api.get_library_albums(limit)
-        return [YtmusicSearchAlbum(**data) for data in response]
+        return [YtmusicSearchAlbum.from_trusted(data) for data in response]
 
     def library_artists(self, limit: int = GLOBAL_LIMIT) -> List[YtmusicLibraryArtist]:
         response = self._api.get_library_artists(limit)
-        return [YtmusicLibraryArtist(**data) for data in response]
+        return [YtmusicLibraryArtist.from_trusted(data) for data in response]
 
     def library_subscription_artists(self, limit: int = GLOBAL_LIMIT) -> List[YtmusicLibraryArtist]:
         response = self._api.get_library_subscriptions(limit)
-        return [YtmusicLibraryArtist(**data) for data in response]
+        return [YtmusicLibraryArtist.from_trusted(data) for data in response]
 
     def playlist_info(self, playlist_id: str, limit: int = GLOBAL_LIMIT) -> PlaylistInfo:
         return PlaylistInfo(**self._api.get_playlist(playlist_id, limit))
@@ -149,50 +304,85 @@ class YtmusicService(metaclass=Singleton):
 
     def history(self) -> List[YtmusicHistorySong]:
         response = self._api.get_history()
-        return [YtmusicHistorySong(**data) for data in response]
+        return [YtmusicHistorySong.from_trusted(data) for data in response]
 
-    @cachetools.cached(cache=CACHE, key=partial(cachetools.keys.hashkey, 'stream_url'))
     def stream_url(self, video_id: str, format_code: int) -> Optional[str]:
-        song_info = self.song_info(video_id)
-        formats = song_info.streamingData.adaptiveFormats
-        for f in formats:
-            if int(f.itag) == format_code:
-                return self._get_stream_url(f, video_id)
-        return None
+        f = self.song_info(video_id).streamingData.adaptive_format(format_code)
+        return self.stream_url_for_format(video_id, f) if f is not None else None
+
+    @cachetools.cached(cache=ExpiringCache(maxsize=200, ttu=_stream_url_ttu), lock=CACHE_LOCK,
+                       key=lambda _, video_id, f: (video_id, int(f.itag)))
+    def stream_url_for_format(self, video_id: str, f: SongInfo.StreamingData.Format) -> Optional[str]:
+        # 调用方已经从 song_info 中选好了格式，无需再次查询和查找
+        return self._get_stream_url(f, video_id)
 
     def _get_stream_url(self, f: SongInfo.StreamingData.Format, video_id: str, retry=True) -> Optional[str]:
         if f.url is not None and f.url != '':
             return f.url
-        sig_ch = f.signatureCipher
-        sig_ex = sig_ch.split('&')
-        res = dict({'s': '', 'url': ''})
-        for sig in sig_ex:
-            for key in res:
-                if sig.find(key + "=") >= 0:
-                    res[key] = unquote(sig[len(key + "="):])
-        if self._js == "":
-            self._get_cipher(video_id)
-        signature = self._cipher.get_signature(ciphered_signature=res['s'])
-        _url = res['url'] + "&sig=" + signature
+        res = parse_signature_cipher(f.signatureCipher)
+        # 多个线程会同时获取播放链接，使用局部引用，避免 cipher 被其他线程替换
+        cipher = self._ensure_cipher(video_id)
+        signature = cipher.get_signature(ciphered_signature=res['s'])
+        _url = f"{res['url']}&{res['sp']}={signature}"
         if retry:
             r = self._session.head(_url)
             if r.status_code == 403:
                 logger.info('[ytmusic] update signature timestamp and try again')
                 self._signature_timestamp = self._api.get_signatureTimestamp()
-            return self._get_stream_url(f, video_id, retry=False)
+                # 播放器可能已更新，让 cipher 过期以便重新检查
+                with self._cipher_lock:
+                    if self._cipher is cipher:
+                        self._cipher_expires_at = 0.0
+                return self._get_stream_url(f, video_id, retry=False)
         return _url
 
+    def _ensure_cipher(self, video_id: str) -> Cipher:
+        with self._cipher_lock:
+            if time.time() > self._cipher_expires_at:
+                self._get_cipher(video_id)
+            elif self._cipher is None:
+                # 从磁盘缓存加载的 base.js 在第一次需要签名时才解析
+                self._cipher = Cipher(js=self._js)
+            return self._cipher
+
     def _get_cipher(self, video_id: str):
+        # 调用方需持有 _cipher_lock
         embed_url = f'https://www.youtube.com/embed/{video_id}'
         embed_html = self._session.get(embed_url).text
         js_url = extract.js_url(embed_html)
-        self._js = self._session.get(js_url).text
-        self._cipher = Cipher(js=self._js)
+        if js_url != self._js_url:
+            # js_url 中包含播放器版本，版本不变时无需重新下载和解析 base.js
+            self._js = self._session.get(js_url).text
+            self._js_url = js_url
+            self._cipher = None
+        if self._cipher is None:
+            self._cipher = Cipher(js=self._js)
+        self._cipher_expires_at = time.time() + CIPHER_TTL
+        self._dump_cipher()
+
+    def _load_cipher(self):
+        # 只读取 base.js，解析推迟到第一次获取播放链接时，启动后不播放就不用付出解析的开销
+        if not CIPHER_CACHE_FILE.exists():
+            return
+        try:
+            data = json.loads(CIPHER_CACHE_FILE.read_text(encoding='utf-8'))
+            expires_at, js_url, js = float(data['expires_at']), str(data['js_url']), str(data['js'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f'[ytmusic] load cipher cache failed: {e}')
+            return
+        if time.time() > expires_at:
+            return
+        self._js, self._js_url, self._cipher_expires_at = js, js_url, expires_at
+
+    def _dump_cipher(self):
+        data = {'expires_at': self._cipher_expires_at, 'js_url': self._js_url, 'js': self._js}
+        try:
+            CIPHER_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            CIPHER_CACHE_FILE.write_text(json.dumps(data), encoding='utf-8')
+        except OSError as e:
+            logger.warning(f'[ytmusic] dump cipher cache failed: {e}')
 
 
 if __name__ == '__main__':
-    # noinspection PyUnresolvedReferences
-    import json
-
-    service = YtmusicService()
-    print(service.stream_url('U0XcqF7rqHk', 251))
+    with YtmusicService() as service:
+        print(service.stream_url('U0XcqF7rqHk', 251))
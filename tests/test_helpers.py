@@ -1,3 +1,5 @@
+import pytest
+
 from fuo_ytmusic import helpers
 
 
@@ -15,3 +17,55 @@ def test_singleton():
     assert id(o1) == id(o2)
     assert o1.variable == 10
     assert o2.variable == 10
+
+
+def test_sqlite_ttl_cache(tmp_path):
+    now = [1000.0]
+    cache = helpers.SqliteTTLCache(tmp_path / 'cache.sqlite', 'test', ttl=10, maxsize=2, timer=lambda: now[0])
+    cache['a'] = {'name': 'a'}
+    cache[('b', 'c')] = [1, 2]
+    assert cache['a'] == {'name': 'a'}
+    assert cache[('b', 'c')] == [1, 2]
+    assert set(cache) == {'a', ('b', 'c')}
+    # 同一个文件的其他 namespace 互不影响，重新打开后数据依然存在
+    other = helpers.SqliteTTLCache(tmp_path / 'cache.sqlite', 'other', ttl=10, timer=lambda: now[0])
+    assert 'a' not in other
+    cache.close()
+    assert cache.get('a') == {'name': 'a'}
+    now[0] += 11
+    assert 'a' not in cache
+    assert len(cache) == 0
+
+
+def test_sqlite_ttl_cache_maxsize(tmp_path):
+    cache = helpers.SqliteTTLCache(tmp_path / 'cache.sqlite', 'test', ttl=10, maxsize=2)
+    for key in ('a', 'b', 'c'):
+        cache[key] = key
+    assert len(cache) == 2
+
+
+def test_sqlite_ttl_cache_unavailable(tmp_path):
+    # 数据目录无法创建时当作没有缓存，写入失败抛出 cachetools.cached 会忽略的 ValueError
+    (tmp_path / 'file').write_text('')
+    cache = helpers.SqliteTTLCache(tmp_path / 'file' / 'cache.sqlite', 'test', ttl=10)
+    assert 'a' not in cache
+    with pytest.raises(ValueError):
+        cache['a'] = 1
+
+
+def test_expiring_cache():
+    now = [1000.0]
+    cache = helpers.ExpiringCache(maxsize=2, ttu=lambda _, value, t: t + value, timer=lambda: now[0])
+    cache['short'] = 5
+    cache['long'] = 20
+    cache['never'] = 0  # 立即过期的条目不会被缓存
+    assert 'never' not in cache
+    assert cache['short'] == 5 and len(cache) == 2
+    now[0] += 10
+    assert 'short' not in cache
+    assert cache['long'] == 20
+    assert cache.get('short') is None and cache.get('long') == 20
+    # 满了之后先清理过期条目，否则淘汰最早写入的
+    cache['a'] = 100
+    cache['b'] = 100
+    assert set(cache) == {'a', 'b'}
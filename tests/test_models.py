@@ -0,0 +1,146 @@
+from feeluown.library import ModelState, SongModel
+from feeluown.media import Quality
+
+from fuo_ytmusic.models import TrackListing, YtmusicLibrarySong, YtmusicSearchSong, YtmusicSearchAlbum, \
+    YtmusicDispatcher, SearchNestedArtist, SearchNestedThumbnail, Categories, SongInfo
+
+TRACKS = [
+    {'videoId': 'v1', 'title': 'Song 1', 'artists': [{'id': 'a1', 'name': 'Artist 1'}],
+     'album': {'id': 'b1', 'name': 'Album 1'}, 'duration': '3:05', 'likeStatus': 'LIKE'},
+    {'videoId': 'v2', 'title': 'Song 2', 'artists': [{'id': None, 'name': 'Artist 2'}],
+     'album': {'id': None, 'name': 'Album 2'}, 'duration': '05:30'},
+    {'videoId': None, 'title': 'Song 3', 'artists': None, 'album': None, 'duration': None},
+]
+
+
+def test_track_listing_from_response():
+    listing = TrackListing.from_response(TRACKS)
+    assert len(listing) == 3
+    assert listing.ids == ['v1', 'v2', None]
+    assert list(listing.duration_ms) == [185000, 330000, 0]
+    song = listing[0]
+    assert isinstance(song, SongModel)
+    assert (song.identifier, song.title, song.duration) == ('v1', 'Song 1', 185000)
+    assert [(a.identifier, a.name) for a in song.artists] == [('a1', 'Artist 1')]
+    assert (song.album.identifier, song.album.name) == ('b1', 'Album 1')
+
+
+def test_track_listing_same_as_search_song_model():
+    listing = TrackListing.from_response(TRACKS[:2])
+    for row, data in zip(listing, TRACKS[:2]):
+        song = YtmusicLibrarySong(**data).model()
+        assert row.identifier == song.identifier and row.title == song.title and row.duration == song.duration
+        assert row.state == song.state
+        assert [(a.identifier, a.name) for a in row.artists] == [(a.identifier, a.name) for a in song.artists]
+        assert (row.album.identifier, row.album.name, row.album.state) == \
+            (song.album.identifier, song.album.name, song.album.state)
+
+
+def test_track_listing_slice():
+    listing = TrackListing.from_response(TRACKS)
+    assert [s.title for s in listing[1:]] == ['Song 2', 'Song 3']
+    assert [s.title for s in listing[::2]] == ['Song 1', 'Song 3']
+    assert listing[-1].title == 'Song 3'
+    assert listing[5:] == []
+
+
+def test_track_listing_null_fields():
+    listing = TrackListing.from_response(TRACKS)
+    assert listing[1].artists[0].identifier == ''
+    assert listing[1].album.state == ModelState.not_exists
+    song = listing[2]
+    assert song.identifier == '' and song.state == ModelState.not_exists
+    assert song.artists == []
+    assert song.album.identifier == '' and song.album.state == ModelState.not_exists
+
+
+SEARCH_SONG = {
+    'category': 'Songs', 'resultType': 'song', 'title': 'Song 1', 'videoId': 'v1', 'duration': '3:05',
+    'album': {'id': 'b1', 'name': 'Album 1'},
+    'artists': [{'id': 'a1', 'name': 'Artist 1'}, {'id': None, 'name': 'Artist 2'}],
+    'thumbnails': [{'url': 'small', 'width': 60, 'height': 60}, {'url': 'large', 'width': 120, 'height': 120}],
+    'feedbackTokens': {'add': None}, 'unknownField': 1,
+}
+
+
+def test_from_trusted_nested():
+    song = YtmusicSearchSong.from_trusted(SEARCH_SONG)
+    assert isinstance(song.album, YtmusicSearchSong.Album)
+    assert all(isinstance(a, SearchNestedArtist) for a in song.artists)
+    assert all(isinstance(t, SearchNestedThumbnail) for t in song.thumbnails)
+    assert song.feedbackTokens == {'add': None}
+    assert song.isExplicit is None  # 缺失的字段使用默认值
+    assert not hasattr(song, 'unknownField')
+    assert song.cover == 'large'
+    assert song.duration_ms == 185000
+
+
+def test_from_trusted_model_same_as_validated():
+    trusted = YtmusicSearchSong.from_trusted(SEARCH_SONG).model()
+    validated = YtmusicSearchSong(**SEARCH_SONG).model()
+    assert (trusted.identifier, trusted.title, trusted.duration) == \
+        (validated.identifier, validated.title, validated.duration)
+    assert [(a.identifier, a.name) for a in trusted.artists] == [('a1', 'Artist 1'), ('', 'Artist 2')]
+    assert (trusted.album.identifier, trusted.album.name) == ('b1', 'Album 1')
+
+
+def test_from_trusted_alias_and_no_coercion():
+    categories = Categories.from_trusted({'For you': [{'title': 'Chill', 'params': 'p1'}]})
+    assert categories.forYou[0].title == 'Chill'
+    assert categories.moods is None
+    # 字段类型不做转换
+    album = YtmusicSearchAlbum.from_trusted({'title': 'Album', 'year': '2020', 'browseId': 'b1'})
+    assert album.year == '2020'
+    assert album.model().identifier == 'b1'
+
+
+def test_dispatcher_from_trusted():
+    result = YtmusicDispatcher.search_result_dispatcher(**SEARCH_SONG)
+    assert type(result) is YtmusicSearchSong
+    assert result.album.id == 'b1'
+    other = YtmusicDispatcher.search_result_dispatcher(category='Episodes', resultType='episode')
+    assert other.resultType == 'episode'
+
+
+SONG_INFO = {
+    'videoDetails': {'videoId': 'v1', 'title': 'Song 1'},
+    'streamingData': {'adaptiveFormats': [
+        {'itag': 136, 'url': 'video-720', 'quality': 'hd720'},
+        {'itag': 249, 'url': 'audio-low', 'audioQuality': 'AUDIO_QUALITY_LOW'},
+        {'itag': 140, 'url': 'audio-medium', 'audioQuality': 'AUDIO_QUALITY_MEDIUM'},
+    ]},
+}
+
+
+def test_song_info_format_selection():
+    song_info = SongInfo(**SONG_INFO)
+    assert song_info.get_media(Quality.Audio.sq).itag == 140
+    assert song_info.get_media(Quality.Audio.lq).itag == 249
+    assert song_info.get_media(Quality.Audio.hq) is None
+    assert song_info.get_mv(Quality.Video.hd).itag == 136
+    assert song_info.get_mv(Quality.Video.fhd) is None
+
+
+def test_adaptive_format():
+    streaming_data = SongInfo(**SONG_INFO).streamingData
+    f = streaming_data.adaptive_format(140)
+    assert f.url == 'audio-medium'
+    assert streaming_data.adaptive_format('140') is f
+    assert streaming_data.adaptive_format(999) is None
+    # 跳过校验构造时 itag 可能还是字符串
+    trusted = SongInfo.StreamingData.from_trusted({'adaptiveFormats': [{'itag': '251', 'url': 'opus'}]})
+    assert trusted.adaptive_format(251).url == 'opus'
+    assert SongInfo.StreamingData.from_trusted({}).adaptive_format(251) is None
+
+
+def test_song_info_quality_lists_memoized():
+    song_info = SongInfo(**SONG_INFO)
+    formats = song_info.list_formats()
+    video_formats = song_info.list_video_formats()
+    assert set(formats) == {Quality.Audio.lq, Quality.Audio.sq}
+    assert video_formats == [Quality.Video.hd]
+    # 第二次调用直接返回缓存的列表，不会重新扫描 adaptiveFormats
+    song_info.streamingData.adaptiveFormats = []
+    assert song_info.list_formats() is formats
+    assert song_info.list_video_formats() is video_formats
+    assert SongInfo(**SONG_INFO).list_formats() is not formats
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+from fuo_ytmusic.provider import YtmusicProvider
+
+
+class _FakeService:
+    def __init__(self, video_ids):
+        self.video_ids = video_ids
+        self.prefetched = []
+
+    def playlist_info(self, identifier, limit=20):
+        tracks = [SimpleNamespace(videoId=video_id) for video_id in self.video_ids]
+        return SimpleNamespace(tracks=tracks, model=lambda: identifier)
+
+    def song_info_many(self, video_ids):
+        self.prefetched.append(video_ids)
+
+
+class _SyncExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+def _provider(video_ids):
+    # 不调用 __init__，避免创建真正的 YtmusicService
+    provider = object.__new__(YtmusicProvider)
+    provider.service = _FakeService(video_ids)
+    provider.prefetch_enabled = True
+    provider._prefetch_executor = _SyncExecutor()
+    provider._prefetch_queue = []
+    return provider
+
+
+def test_prefetch_window():
+    provider = _provider(['v1', None, 'v2', 'v3', 'v4', 'v5'])
+    assert provider.playlist_info('pl') == 'pl'
+    # 没有 videoId 的歌曲会被跳过
+    assert provider.service.prefetched == [['v1', 'v2', 'v3']]
+    provider._prefetch_next('v2')
+    assert provider.service.prefetched[-1] == ['v3', 'v4', 'v5']
+    # 最后一首和不在歌单中的歌曲不触发预取
+    provider._prefetch_next('v5')
+    provider._prefetch_next('other')
+    assert len(provider.service.prefetched) == 2
+
+
+def test_prefetch_disabled():
+    provider = _provider(['v1', 'v2'])
+    provider.prefetch_enabled = False
+    provider.playlist_info('pl')
+    provider._prefetch_next('v1')
+    assert provider.service.prefetched == []
+    # 歌单依然记录下来，重新打开预取后立即生效
+    provider.prefetch_enabled = True
+    provider._prefetch_next('v1')
+    assert provider.service.prefetched == [['v2']]
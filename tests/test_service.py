@@ -1,9 +1,208 @@
+import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
 
 from feeluown.models import SearchType
 
 from fuo_ytmusic import service
-from fuo_ytmusic.models import YtmusicSearchSong, YtmusicSearchAlbum
+from fuo_ytmusic.helpers import ExpiringCache
+from fuo_ytmusic.models import BaseModel, SongInfo, YtmusicSearchSong, YtmusicSearchAlbum
+
+
+def test_parse_signature_cipher():
+    res = service.parse_signature_cipher('s=AB%3DCD&sp=sig&url=https%3A%2F%2Fexample.com%2Fplay%3Fxs%3D1')
+    assert res == {'s': 'AB=CD', 'sp': 'sig', 'url': 'https://example.com/play?xs=1'}
+    assert service.parse_signature_cipher('url=https%3A%2F%2Fexample.com') == \
+        {'s': '', 'sp': 'sig', 'url': 'https://example.com'}
+
+
+def test_stream_url_expires_at():
+    assert service.stream_url_expires_at('https://example.com/videoplayback?expire=1700000000&ei=x') == 1700000000
+    assert service.stream_url_expires_at('https://example.com/videoplayback?ei=x') is None
+
+
+def test_ytmusicapi_json_uses_orjson(monkeypatch):
+    orjson = pytest.importorskip('orjson')
+    from ytmusicapi import ytmusic
+    calls = []
+    orjson_loads = orjson.loads
+
+    def loads(s):
+        calls.append(s)
+        return orjson_loads(s)
+
+    monkeypatch.setattr(service.orjson, 'loads', loads)
+    # 与 ytmusicapi 解析响应的方式一致
+    assert ytmusic.json.loads('{"contents": [1, 2]}') == {'contents': [1, 2]}
+    assert calls == ['{"contents": [1, 2]}']
+    assert ytmusic.json.load is json.load
+
+
+def test_meta_cache_namespace_follows_model(tmp_path, monkeypatch):
+    monkeypatch.setattr(service, 'CACHE_DB_FILE', tmp_path / 'cache.sqlite')
+
+    class Info(BaseModel):
+        name: str
+
+    old = service._meta_cache('info', Info, 60, maxsize=10)
+    old['a'] = {'name': 'a'}
+    assert service._meta_cache('info', Info, 60, maxsize=10)['a'] == {'name': 'a'}
+
+    class Info(BaseModel):  # noqa: F811
+        name: str
+        year: int
+
+    # 模型加了字段之后不再读到旧结构的缓存
+    assert 'a' not in service._meta_cache('info', Info, 60, maxsize=10)
+
+
+def _bare_service():
+    # 不调用 __init__，避免 setup 时访问网络
+    svc = object.__new__(service.YtmusicService)
+    svc._js, svc._js_url, svc._cipher, svc._cipher_expires_at = '', '', None, 0.0
+    svc._cipher_lock = threading.Lock()
+    return svc
+
+
+def test_cipher_cache_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(service, 'CIPHER_CACHE_FILE', tmp_path / 'cipher.json')
+    svc = _bare_service()
+    svc._js, svc._js_url, svc._cipher_expires_at = 'var a;', '/s/player/abc/base.js', time.time() + 60
+    svc._dump_cipher()
+
+    built = []
+    monkeypatch.setattr(service, 'Cipher', lambda js: built.append(js) or 'cipher')
+    loaded = _bare_service()
+    loaded._load_cipher()
+    assert (loaded._js, loaded._js_url) == ('var a;', '/s/player/abc/base.js')
+    # 加载时不解析 base.js，第一次签名时才构造，并且不需要访问网络
+    assert loaded._cipher is None and built == []
+    assert loaded._ensure_cipher('video') == 'cipher'
+    assert built == ['var a;']
+
+
+def test_cipher_cache_ignore_expired(tmp_path, monkeypatch):
+    monkeypatch.setattr(service, 'CIPHER_CACHE_FILE', tmp_path / 'cipher.json')
+    svc = _bare_service()
+    svc._js, svc._js_url, svc._cipher_expires_at = 'var a;', '/s/player/abc/base.js', time.time() - 1
+    svc._dump_cipher()
+    loaded = _bare_service()
+    loaded._load_cipher()
+    assert (loaded._js, loaded._js_url, loaded._cipher_expires_at) == ('', '', 0.0)
+
+
+@pytest.mark.parametrize('content', ['not json', '[1, 2, 3]', '{"expires_at": "soon", "js_url": "", "js": ""}'])
+def test_cipher_cache_ignore_invalid(tmp_path, monkeypatch, content):
+    monkeypatch.setattr(service, 'CIPHER_CACHE_FILE', tmp_path / 'cipher.json')
+    service.CIPHER_CACHE_FILE.write_text(content)
+    loaded = _bare_service()
+    loaded._load_cipher()
+    assert (loaded._js, loaded._js_url, loaded._cipher_expires_at) == ('', '', 0.0)
+
+
+class _FakeSongApi:
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.gate = threading.Event()  # 清除后 get_song 会阻塞，用来模拟还没完成的请求
+        self.gate.set()
+
+    def get_song(self, video_id, signature_timestamp=None):
+        self.calls.append(video_id)
+        self.started.set()
+        self.gate.wait(1)
+        if video_id == 'bad':
+            raise KeyError(video_id)
+        return {'videoDetails': {'videoId': video_id}}
+
+
+def _song_service(timer=time.monotonic, maxsize=service.SONG_CACHE_SIZE):
+    # 与 __init__ 中的缓存配置一致，只是可以替换计时器和大小
+    svc = object.__new__(service.YtmusicService)
+    svc._api, svc._signature_timestamp, svc._song_pending = _FakeSongApi(), 0, {}
+    svc._song_cache = ExpiringCache(maxsize=maxsize, ttu=service._song_ttu, timer=timer)
+    svc._executor = ThreadPoolExecutor(max_workers=2)
+    return svc
+
+
+def test_song_info_cache_ttl():
+    now = [100.0]
+    svc = _song_service(timer=lambda: now[0])
+    first = svc.song_info('v1')
+    assert svc.song_info('v1') is first
+    assert svc._api.calls == ['v1']
+    now[0] += service.SONG_TTL - 1
+    assert svc.song_info('v1') is first
+    # 过期之后重新请求
+    now[0] += 2
+    assert svc.song_info('v1') is not first
+    assert svc._api.calls == ['v1', 'v1']
+
+
+def test_song_info_cache_eviction():
+    now = [100.0]
+    svc = _song_service(timer=lambda: now[0], maxsize=3)
+    svc.song_info('v1')
+    now[0] += 1
+    svc.song_info('v2')
+    svc.song_info('v3')
+    # 缓存满了淘汰最早写入的
+    now[0] += 1
+    svc.song_info('v4')
+    assert list(svc._song_cache) == ['v2', 'v3', 'v4']
+    # 有过期条目时先清理过期的
+    now[0] += service.SONG_TTL - 0.5
+    svc.song_info('v5')
+    assert list(svc._song_cache) == ['v4', 'v5']
+
+
+def test_song_info_many_fills_cache():
+    svc = _song_service()
+    results = svc.song_info_many(['v1', 'bad', 'v2', 'v1'])
+    assert list(results) == ['v1', 'v2']
+    assert set(svc._song_cache) == {'v1', 'v2'}
+    assert svc.song_info('v2') is results['v2']
+    assert sorted(svc._api.calls) == ['bad', 'v1', 'v2']
+    svc._executor.shutdown()
+
+
+@pytest.mark.parametrize('video_id', ['v1', 'bad'])
+def test_song_info_waits_for_pending_fetch(video_id):
+    svc = _song_service()
+    svc._api.gate.clear()
+    first = svc._executor.submit(svc.song_info, video_id)
+    assert svc._api.started.wait(1)
+    second = svc._executor.submit(svc.song_info, video_id)
+    time.sleep(0.05)  # 让第二个调用进入等待
+    svc._api.gate.set()
+    if video_id == 'bad':
+        # 失败时等待的调用拿到同一个异常，之后还可以重新请求
+        for future in (first, second):
+            with pytest.raises(KeyError):
+                future.result(1)
+    else:
+        assert first.result(1) is second.result(1)
+    assert svc._api.calls == [video_id]
+    assert svc._song_pending == {}
+    svc._executor.shutdown()
+
+
+def test_stream_url_for_format_cached_by_itag():
+    svc = object.__new__(service.YtmusicService)
+    song_info = SongInfo(**{'streamingData': {'adaptiveFormats': [{'itag': 140, 'url': 'audio'}]}})
+    svc.song_info = lambda video_id: song_info
+    calls = []
+    svc._get_stream_url = lambda f, video_id: calls.append(f.itag) or f'{f.url}?id={video_id}'
+    f = song_info.streamingData.adaptive_format(140)
+    assert svc.stream_url_for_format('stream-test', f) == 'audio?id=stream-test'
+    # 按 (video_id, itag) 缓存，stream_url 查找到同一格式后命中缓存
+    assert svc.stream_url('stream-test', '140') == 'audio?id=stream-test'
+    assert calls == [140]
+    assert svc.stream_url('stream-test', 999) is None
 
 
 class TestService: